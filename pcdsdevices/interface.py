@@ -353,8 +353,8 @@ class Presets:
     active, and related utilities.
 
     It will install the ``mv_presetname`` and ``wm_presetname`` methods onto
-    the associated device, and the ``add_preset`` and ``add_preset_here``
-    methods onto itself.
+    the associated device, and the ``add_preset``, ``add_preset_here`` and
+    ``add_many_preset`` methods onto itself.
 
     Parameters
     ----------
@@ -367,6 +367,11 @@ class Presets:
     positions: ``SimpleNamespace``
         A namespace that contains all of the active presets as `PresetPosition`
         objects.
+
+    generation: ``int``
+        Incremented every time the presets are reloaded by `sync`. Anything
+        derived from the preset values can compare against this to know when
+        it needs to be recomputed.
     """
     _registry = WeakSet()
     _paths = {}
@@ -377,6 +382,7 @@ class Presets:
         self._fd = None
         self._registry.add(self)
         self.name = device.name + '_presets'
+        self.generation = 0
         self.sync()
 
     def _path(self, preset_type):
@@ -468,12 +474,28 @@ class Presets:
         logger.debug(('call %s presets._update(%s, %s, value=%s, comment=%s, '
                       'active=%s)'), self._device.name, preset_type, name,
                      value, comment, active)
-        if not isinstance(name, str):
-            raise TypeError(('name must be of type <str>, not type'
-                             '{}'.format(type(name))))
-        if value is not None and not isinstance(value, numbers.Real):
-            raise TypeError(('value must be a real numeric type, not type'
-                             '{}'.format(type(value))))
+        self._update_many(preset_type, {name: value}, comment=comment,
+                          active=active)
+
+    def _update_many(self, preset_type, values, comment=None, active=True):
+        """
+        Utility function to update several preset positions at once.
+
+        Works like `_update`, but takes a mapping from preset name to value
+        and applies all of them under a single file read and write.
+        """
+        logger.debug(('call %s presets._update_many(%s, %s, comment=%s, '
+                      'active=%s)'), self._device.name, preset_type, values,
+                     comment, active)
+        for name, value in values.items():
+            if not isinstance(name, str):
+                raise TypeError(('name must be of type <str>, not type'
+                                 '{}'.format(type(name))))
+            if value is not None and not isinstance(value, numbers.Real):
+                raise TypeError(('value must be a real numeric type, not type'
+                                 '{}'.format(type(value))))
+        if comment:
+            comment = ' ' + comment
         try:
             path = self._path(preset_type)
             if not path.exists():
@@ -481,24 +503,22 @@ class Presets:
                 path.chmod(0o666)
             with self._file_open_rlock(preset_type):
                 data = self._read(preset_type)
-                if value is None and comment is not None:
-                    value = data[name]['value']
-                if value is not None:
-                    if name not in data:
-                        data[name] = {}
-                    ts = time.strftime('%d %b %Y %H:%M:%S')
-                    data[name]['value'] = value
-                    history = data[name].get('history', {})
-                    if comment:
-                        comment = ' ' + comment
+                ts = time.strftime('%d %b %Y %H:%M:%S')
+                for name, value in values.items():
+                    if value is None and comment is not None:
+                        value = data[name]['value']
+                    if value is not None:
+                        if name not in data:
+                            data[name] = {}
+                        data[name]['value'] = value
+                        history = data[name].get('history', {})
+                        history[ts] = '{:10.4f}{}'.format(value,
+                                                          comment or '')
+                        data[name]['history'] = history
+                    if active:
+                        data[name]['active'] = True
                     else:
-                        comment = ''
-                    history[ts] = '{:10.4f}{}'.format(value, comment)
-                    data[name]['history'] = history
-                if active:
-                    data[name]['active'] = True
-                else:
-                    data[name]['active'] = False
+                        data[name]['active'] = False
                 self._write(preset_type, data)
         except BlockingIOError:
             self._log_flock_error()
@@ -509,6 +529,7 @@ class Presets:
         """
         logger.debug('call %s presets.sync()', self._device.name)
         self._remove_methods()
+        self.generation += 1
         self._cache = {}
         logger.debug('filling %s cache', self.name)
         for preset_type in self._paths.keys():
@@ -539,9 +560,10 @@ class Presets:
         """
         logger.debug('call %s presets._create_methods()', self._device.name)
         for preset_type in self._paths.keys():
-            add, add_here = self._make_add(preset_type)
+            add, add_here, add_many = self._make_add(preset_type)
             self._register_method(self, 'add_' + preset_type, add)
             self._register_method(self, 'add_here_' + preset_type, add_here)
+            self._register_method(self, 'add_many_' + preset_type, add_many)
         for preset_type, data in self._cache.items():
             for name, info in data.items():
                 if info['active']:
@@ -568,8 +590,9 @@ class Presets:
         """
         Create the functions that add preset positions.
 
-        Creates suitable versions of ``add`` and ``add_here`` for a particular
-        preset type, e.g. ``add_preset_type`` and ``add_here_preset_type``.
+        Creates suitable versions of ``add``, ``add_here`` and ``add_many``
+        for a particular preset type, e.g. ``add_preset_type``,
+        ``add_here_preset_type`` and ``add_many_preset_type``.
         """
         def add(self, name, value, comment=None):
             """
@@ -604,9 +627,28 @@ class Presets:
             """
             add(self, name, self._device.wm(), comment=comment)
 
+        def add_many(self, positions, comment=None):
+            """
+            Add several preset positions of type "{}" at once.
+
+            This writes the preset file only once for all of the positions.
+
+            Parameters
+            ----------
+            positions: ``dict``
+                A mapping from the names of the new preset positions to their
+                values.
+
+            comment: ``str``, optional
+                A comment to associate with each of the preset positions.
+            """
+            self._update_many(preset_type, positions, comment=comment)
+            self.sync()
+
         add.__doc__ = add.__doc__.format(preset_type)
         add_here.__doc__ = add_here.__doc__.format(preset_type)
-        return add, add_here
+        add_many.__doc__ = add_many.__doc__.format(preset_type)
+        return add, add_here, add_many
 
     def _make_mv_pre(self, preset_type, name):
         """
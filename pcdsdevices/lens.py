@@ -1,7 +1,13 @@
 """
 Basic Beryllium Lens XFLS
 """
-import time
+import copy
+import json
+import math
+import numbers
+import os
+from functools import lru_cache
+
 import numpy as np
 import yaml
 import shutil
@@ -10,6 +16,8 @@ from datetime import date
 from ophyd.device import Component as Cpt, FormattedComponent as FCpt
 from ophyd.pseudopos import (PseudoPositioner, PseudoSingle,
                              pseudo_position_argument, real_position_argument)
+from ophyd.status import wait as status_wait
+from ophyd.utils import OpException
 
 from periodictable import xsf
 
@@ -19,7 +27,110 @@ from .inout import InOutRecordPositioner
 from .interface import tweak_base
 from .sim import FastMotor
 
-LENS_RADII = [50e-6, 100e-6, 200e-6, 300e-6, 500e-6, 1000e-6, 1500e-6]
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
+LENS_RADII = np.array([50e-6, 100e-6, 200e-6, 300e-6, 500e-6, 1000e-6,
+                       1500e-6])
+LENS_RADII.setflags(write=False)
+
+# Conversions between a gaussian FWHM and the 2*sigma w parameter
+_FWHM_TO_SIGMA2 = 2./2.35
+_SIGMA2_TO_FWHM = 2.35/2.
+# hc in keV*m, for wavelengths from energies in keV
+_HC = 12.398e-10
+# Solutions before and after the focus
+_PM_ONE = np.array([-1., 1.])
+_PM_ONE.setflags(write=False)
+
+
+@lru_cache(maxsize=128)
+def _delta_cached(E, material, density):
+    """
+    Memoized refractive index decrement, the xsf lookup is expensive.
+    """
+    return 1-np.real(xsf.index_of_refraction(material, density=density,
+                                             energy=E))
+
+
+@lru_cache(maxsize=32)
+def _focal_length(E, lens_set, material, density):
+    """
+    Memoized focal length of a (n1, radius1, n2, radius2, ...) lens set.
+
+    lens_set must be passed as a tuple so that it can be hashed.
+    """
+    pairs = np.asarray(lens_set[:len(lens_set)//2*2],
+                       dtype=object).reshape(-1, 2)
+    # Skip empty lens slots
+    mask = np.array([rad is not None for rad in pairs[:, 1]], dtype=bool)
+    if not mask.any():
+        raise ZeroDivisionError('Lens set {} has no lenses, focal length is '
+                                'undefined'.format(lens_set))
+    nums = pairs[mask, 0].astype(np.float64)
+    rads = pairs[mask, 1].astype(np.float64)
+    # Every lens shares the same delta, 1/f = sum(n*2*delta/r)
+    delta = _delta_cached(float(E), material, density)
+    return 1./np.sum(nums*2.*delta/rads)
+
+
+def _wavelength(E):
+    """
+    Photon wavelength in meters for an energy in keV.
+    """
+    return _HC/E
+
+
+@lru_cache(maxsize=32)
+def _beam_geometry(E, lens_set, fwhm_unfocused, material, density):
+    """
+    Memoized focal length, waist and rayleigh range for a lens set.
+
+    lens_set must be passed as a tuple so that it can be hashed.
+    """
+    f = _focal_length(E, lens_set, material, density)
+    lam = _wavelength(E)
+    # the w parameter used in the usual formula is 2*sigma
+    w_unfocused = fwhm_unfocused*_FWHM_TO_SIGMA2
+    # assuming gaussian beam divergence = w_unfocused/f we can obtain
+    waist = lam/np.pi*f/w_unfocused
+    rayleigh_range = np.pi*waist*waist/lam
+    return f, waist, rayleigh_range
+
+
+def _beam_fwhm_core(distance, f, waist, rayleigh_range):
+    """
+    Gaussian beam 2*sigma size at distance from a lens of focal length f.
+    """
+    offset = (distance-f)/rayleigh_range
+    if np.isscalar(distance):
+        # Skip the numpy ufunc overhead for single points, e.g. inverse
+        return waist*math.sqrt(1.+offset*offset)
+    return waist*np.sqrt(1.+offset*offset)
+
+
+def _dist_for_size_core(sizeFWHM, f, waist, rayleigh_range):
+    """
+    Distances before and after the focus where the beam has size sizeFWHM.
+
+    For an array of sizes, the result has shape (2, len(sizeFWHM)).
+    """
+    ratio = sizeFWHM*_FWHM_TO_SIGMA2/waist
+    return (np.multiply.outer(_PM_ONE, np.sqrt(ratio*ratio-1))
+            * rayleigh_range) + f
+
+
+def _lens_file_value(value):
+    """
+    Convert one lens set entry to a json serializable python number.
+    """
+    if value is None:
+        return None
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    return float(value)
 
 
 class XFLS(InOutRecordPositioner):
@@ -58,6 +169,9 @@ class LensStackBase(PseudoPositioner):
     tab_whitelist = ['tweak', 'align']
     tab_component_names = True
 
+    # Seconds to wait for the attenuator before a move
+    _safe_insert_timeout = 1.0
+
     def __init__(self, x_prefix, y_prefix, z_prefix, lens_set=None,
                  z_offset=None, z_dir=None, E=None, att_obj=None,
                  lcls_obj=None, mono_obj=None, beamsize_unfocused=500e-6,
@@ -70,7 +184,11 @@ class LensStackBase(PseudoPositioner):
         self.beamsize_unfocused = beamsize_unfocused
 
         self._E = E
+        self._align_coef = None
+        self._last_fwd = (None, None)
         self._att_obj = att_obj
+        self._filter_thicknesses = None
+        self._thickest_idx = None
         self._lcls_obj = lcls_obj
         self._mono_obj = mono_obj
         if lens_set is not None:
@@ -81,17 +199,9 @@ class LensStackBase(PseudoPositioner):
 
     def calc_distance_for_size(self, sizeFWHM, lens_set, E=None,
                                fwhm_unfocused=None):
-        size = sizeFWHM*2./2.35
-        f = self.calc_focal_length(E, lens_set, 'Be', None)
-        lam = 12.398/E*1e-10
-        # the w parameter used in the usual formula is 2*sigma
-        w_unfocused = fwhm_unfocused*2/2.35
-        # assuming gaussian beam divergence = w_unfocused/f we can obtain
-        waist = lam/np.pi*f/w_unfocused
-        rayleigh_range = np.pi*waist**2/lam
-        distance = ((np.sqrt((size/waist)**2-1)*np.asarray([-1., 1.])
-                     * rayleigh_range) + f)
-        return distance
+        geometry = _beam_geometry(float(E), tuple(lens_set),
+                                  float(fwhm_unfocused), 'Be', None)
+        return _dist_for_size_core(sizeFWHM, *geometry)
 
     def tweak(self):
         """
@@ -106,39 +216,94 @@ class LensStackBase(PseudoPositioner):
     @pseudo_position_argument
     def forward(self, pseudo_pos):
         if not np.isclose(pseudo_pos.beam_size, self.beam_size.position):
-            beam_size = pseudo_pos.beam_size
-            dist = self.calc_distance_for_size(beam_size, self.lens_set,
-                                               self._E,
-                                               self.beamsize_unfocused)[0]
-            z_pos = (dist - self.z_offset) * self.z_dir * 1000
+            # Repeated requests for the same beam size reuse the last z
+            key = (pseudo_pos.beam_size, self._E, self.beamsize_unfocused,
+                   self.z_offset, self.z_dir, tuple(self.lens_set))
+            last_key, z_pos = self._last_fwd
+            if key != last_key:
+                dist = self.calc_distance_for_size(pseudo_pos.beam_size,
+                                                   self.lens_set, self._E,
+                                                   self.beamsize_unfocused)[0]
+                z_pos = (dist - self.z_offset) * self.z_dir * 1000
+                self._last_fwd = (key, z_pos)
         else:
             z_pos = pseudo_pos.calib_z
+        return self._aligned_real_position(z_pos)
+
+    def forward_many(self, beam_sizes):
+        """
+        Vectorized `forward` for an array of beam sizes.
+
+        This is useful for plans that precompute a trajectory, as the whole
+        array goes through the calculation at once.
+
+        Parameters
+        ----------
+        beam_sizes: ``array-like``
+            The beam sizes to calculate real positions for.
+
+        Returns
+        -------
+        real_pos: ``RealPosition``
+            The real positions, with an array for each axis.
+        """
+        beam_sizes = np.asarray(beam_sizes, dtype=np.float64)
+        dist = self.calc_distance_for_size(beam_sizes, self.lens_set, self._E,
+                                           self.beamsize_unfocused)[0]
+        z_pos = (dist - self.z_offset) * self.z_dir * 1000
+        return self._aligned_real_position(z_pos)
+
+    def _aligned_real_position(self, z_pos):
+        """
+        Return the real position on the aligned beam line for z_pos.
+
+        z_pos can be a scalar or an array.
+        """
         try:
-            pos = [self.x.presets.positions.align_position_one.pos,
-                   self.y.presets.positions.align_position_one.pos,
-                   self.z.presets.positions.align_position_one.pos,
-                   self.x.presets.positions.align_position_two.pos,
-                   self.y.presets.positions.align_position_two.pos,
-                   self.z.presets.positions.align_position_two.pos]
-            x_pos = ((pos[0]-pos[3])/(pos[2]-pos[5]))*(z_pos-pos[2])+pos[0]
-            y_pos = ((pos[1]-pos[4])/(pos[2]-pos[5]))*(z_pos-pos[2])+pos[1]
-            return self.RealPosition(x=x_pos, y=y_pos, z=z_pos)
+            mx, bx, my, by = self._ensure_align_coef()
         except AttributeError:
             self.log.debug('', exc_info=True)
             self.log.error("Please setup the pseudo motor for use by using "
                            "the align() method.  If you have already done "
                            "that, check if the preset pathways have been "
                            "setup.")
-            return self.RealPosition(x=self.x.position, y=self.y.position,
+            return self.RealPosition(x=self.x.position + np.zeros_like(z_pos),
+                                     y=self.y.position + np.zeros_like(z_pos),
                                      z=z_pos)
+        return self.RealPosition(x=mx*z_pos + bx, y=my*z_pos + by, z=z_pos)
+
+    def _ensure_align_coef(self):
+        """
+        Return the (mx, bx, my, by) coefficients of the beam line.
+
+        These are derived from the align presets, so they are cached until
+        the generation of any of the motors' presets changes.
+        """
+        generations = (self.x.presets.generation, self.y.presets.generation,
+                       self.z.presets.generation)
+        if self._align_coef is not None:
+            cached_generations, coef = self._align_coef
+            if generations == cached_generations:
+                return coef
+        pos = [self.x.presets.positions.align_position_one.pos,
+               self.y.presets.positions.align_position_one.pos,
+               self.z.presets.positions.align_position_one.pos,
+               self.x.presets.positions.align_position_two.pos,
+               self.y.presets.positions.align_position_two.pos,
+               self.z.presets.positions.align_position_two.pos]
+        mx = (pos[0]-pos[3])/(pos[2]-pos[5])
+        my = (pos[1]-pos[4])/(pos[2]-pos[5])
+        coef = (mx, pos[0] - mx*pos[2], my, pos[1] - my*pos[2])
+        self._align_coef = (generations, coef)
+        return coef
 
     @real_position_argument
     def inverse(self, real_pos):
         dist_m = real_pos.z / 1000 * self.z_dir + self.z_offset
-        print('dist_m', dist_m)
         beamsize = self.calc_beam_fwhm(self._E, self.lens_set, distance=dist_m,
                                        material="Be", density=None,
-                                       fwhm_unfocused=self.beamsize_unfocused)
+                                       fwhm_unfocused=self.beamsize_unfocused,
+                                       printsummary=False)
         return self.PseudoPosition(calib_z=real_pos.z, beam_size=beamsize)
 
     def align(self, z_position=None, edge_offset=20):
@@ -162,12 +327,9 @@ class LensStackBase(PseudoPositioner):
         self.tweak()
         pos.extend([self.x.position, self.y.position, self.z.position])
         try:
-            self.x.presets.add_hutch(value=pos[0], name="align_position_one")
-            self.x.presets.add_hutch(value=pos[3], name="align_position_two")
-            self.y.presets.add_hutch(value=pos[1], name="align_position_one")
-            self.y.presets.add_hutch(value=pos[4], name="align_position_two")
-            self.z.presets.add_hutch(value=pos[2], name="align_position_one")
-            self.z.presets.add_hutch(value=pos[5], name="align_position_two")
+            for i, motor in enumerate((self.x, self.y, self.z)):
+                motor.presets.add_many_hutch({'align_position_one': pos[i],
+                                              'align_position_two': pos[i+3]})
         except AttributeError:
             self.log.debug('', exc_info=True)
             self.log.error("No folder setup for motor presets. "
@@ -185,26 +347,11 @@ class LensStackBase(PseudoPositioner):
                                 moved_cb=moved_cb)
 
     def get_delta(self, E, material="Be", density=None):
-        delta = 1-np.real(xsf.index_of_refraction(material, density=density,
-                          energy=E))
-        return delta
+        return _delta_cached(float(E), material, density)
 
     def calc_focal_length(self, E, lens_set, material="Be", density=None):
         # lens_set = (n1,radius1,n2,radius2,...)
-        num = []
-        rad = []
-        ftot_inverse = 0
-        for i in range(len(lens_set)//2):
-            num = lens_set[2*i]
-            rad = lens_set[2*i+1]
-            if rad is not None:
-                rad = float(rad)
-                num = float(num)
-                fln = self.calc_focal_length_for_single_lens(E, rad,
-                                                             material,
-                                                             density)
-                ftot_inverse += num/fln
-        return 1./ftot_inverse
+        return _focal_length(float(E), tuple(lens_set), material, density)
 
     def calc_focal_length_for_single_lens(self, E, radius,
                                           material="Be", density=None):
@@ -214,23 +361,19 @@ class LensStackBase(PseudoPositioner):
 
     def calc_beam_fwhm(self, E, lens_set, distance=None, material="Be",
                        density=None, fwhm_unfocused=None, printsummary=True):
-        f = self.calc_focal_length(E, lens_set, material, density)
-        lam = 1.2398/E*1e-9
-        # the w parameter used in the usual formula is 2*sigma
-        w_unfocused = fwhm_unfocused*2/2.35
-        # assuming gaussian beam divergence = w_unfocused/f we can obtain
-        waist = lam/np.pi*f/w_unfocused
-        rayleigh_range = np.pi*waist**2/lam
-        size = waist*np.sqrt(1.+(distance-f)**2./rayleigh_range**2)
+        f, waist, rayleigh_range = _beam_geometry(float(E), tuple(lens_set),
+                                                  float(fwhm_unfocused),
+                                                  material, density)
+        size = _beam_fwhm_core(distance, f, waist, rayleigh_range)
         if printsummary:
             print("FWHM at lens   : %.3e" % (fwhm_unfocused))
             print("waist          : %.3e" % (waist))
-            print("waist FWHM     : %.3e" % (waist*2.35/2.))
+            print("waist FWHM     : %.3e" % (waist*_SIGMA2_TO_FWHM))
             print("rayleigh_range : %.3e" % (rayleigh_range))
             print("focal length   : %.3e" % (f))
             print("size           : %.3e" % (size))
-            print("size FWHM      : %.3e" % (size*2.35/2.))
-        return size*2.35/2
+            print("size FWHM      : %.3e" % (size*_SIGMA2_TO_FWHM))
+        return size*_SIGMA2_TO_FWHM
 
     def _make_safe(self):
         """
@@ -242,14 +385,16 @@ class LensStackBase(PseudoPositioner):
             print("WARNING: Cannot do safe crl moveZ,\
                        no attenuator object provided.")
             return False
-        filt, thk = self._att_obj.filters[0], 0
-        for f in self._att_obj.filters:
-            t = f.thickness.get()
-            if t > thk:
-                filt, thk = f, t
+        filt = self._get_thickest_filter()
         if not filt.inserted:
-            filt.insert()
-            time.sleep(0.01)
+            # Wait on the insertion itself rather than a fixed delay
+            status = filt.insert(timeout=self._safe_insert_timeout)
+            try:
+                status_wait(status)
+            except (OpException, TimeoutError, RuntimeError) as exc:
+                self.log.debug('', exc_info=True)
+                self.log.warning('Failed to insert attenuator filter %s: %s',
+                                 filt.name, exc)
         if filt.inserted:
             print("REMINDER: Beam stop attenuator moved in!")
             safe = True
@@ -258,24 +403,64 @@ class LensStackBase(PseudoPositioner):
             safe = False
         return safe
 
+    def _get_thickest_filter(self):
+        """
+        Return the thickest filter of the attenuator.
+
+        The filter thicknesses are fixed hardware, so the scan is only done
+        on the first call.
+        """
+        if self._thickest_idx is None:
+            self._filter_thicknesses = np.fromiter(
+                (f.thickness.get() for f in self._att_obj.filters),
+                dtype=np.float64)
+            self._thickest_idx = int(np.argmax(self._filter_thicknesses))
+        return self._att_obj.filters[self._thickest_idx]
+
 
 class LensStack(LensStackBase):
+    # Parsed lens files, path -> (modification time, data)
+    _lens_file_cache = {}
+
     def __init__(self, *args, path, **kwargs):
         self.path = path
         lens_set = self.read_lens()
         super().__init__(*args, lens_set=lens_set, **kwargs)
 
     def read_lens(self):
-        with open(self.path, 'r') as f:
-            read_data = yaml.safe_load(f)
-        return read_data
+        mtime = os.stat(self.path).st_mtime_ns
+        cached_mtime, read_data = self._lens_file_cache.get(self.path,
+                                                            (None, None))
+        if cached_mtime != mtime:
+            with open(self.path, 'r') as f:
+                text = f.read()
+            try:
+                read_data = json.loads(text)
+            except ValueError:
+                # Legacy yaml lens file
+                read_data = yaml.load(text, Loader=_Loader)
+            self._lens_file_cache[self.path] = (mtime, read_data)
+        return copy.deepcopy(read_data)
 
     def create_lens(self, lens_set, make_backup=True):
         # Make a backup with today's date
         if make_backup:
             shutil.copyfile(self.path, self.backup_path)
-        with open(self.path, "w") as f:
-            yaml.dump(self.lens_set, f)
+        self._lens_file_cache.pop(self.path, None)
+        # Plain python numbers, json can't serialize numpy scalars
+        lens_set = [_lens_file_value(value) for value in lens_set]
+        # Write to a temporary file first so a failure can't corrupt the file
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(lens_set, f)
+            if os.path.exists(self.path):
+                shutil.copymode(self.path, tmp_path)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.lens_set = lens_set
 
     @property
     def backup_path(self):
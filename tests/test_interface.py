@@ -159,6 +159,22 @@ def test_presets(presets, fast_motor):
     assert hasattr(fast_motor, 'mv_sample')
 
 
+def test_presets_many(presets, fast_motor):
+    logger.debug('test_presets_many')
+
+    fast_motor.mv(3, wait=True)
+    generation = fast_motor.presets.generation
+    fast_motor.presets.add_many_hutch({'one': 1, 'two': 2}, comment='pair')
+    assert fast_motor.presets.generation > generation
+    assert fast_motor.wm_one() == -2
+    assert fast_motor.wm_two() == -1
+    assert len(fast_motor.presets.positions.one.history) == 1
+    assert 'pair' in list(fast_motor.presets.positions.two.history.values())[0]
+
+    with pytest.raises(TypeError):
+        fast_motor.presets.add_many_hutch({'three': 'cats'})
+
+
 def test_presets_type(presets, fast_motor):
     logger.debug('test_presets_type')
     # Mess up the input types, fail before opening the file
@@ -1,13 +1,18 @@
 import logging
 import os
 import os.path
+import shutil
 
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 from ophyd.sim import make_fake_device
+from ophyd.status import StatusBase
+from ophyd.utils import UnknownStatusFailure
 import pytest
 import numpy as np
 
-from pcdsdevices.lens import XFLS, LensStack, SimLensStack, LensStackBase
+import pcdsdevices.lens
+from pcdsdevices.lens import (XFLS, LensStack, SimLensStack, LensStackBase,
+                              _delta_cached)
 
 logger = logging.getLogger(__name__)
 
@@ -71,7 +76,7 @@ def fake_lensstack(fake_att):
     return fake_lensstack
 
 
-def test_lensstack_beamsize(monkeypatch, fake_lensstack):
+def test_lensstack_beamsize(capsys, monkeypatch, fake_lensstack):
     logger.debug('test_lensstackbeamsize')
     lensstack = fake_lensstack
     lensstack.beam_size.move(500e-6)
@@ -82,6 +87,33 @@ def test_lensstack_beamsize(monkeypatch, fake_lensstack):
     monkeypatch.setattr(LensStackBase, 'tweak', mocktweak)
     lensstack.align(0)
     assert np.isclose(lensstack.beam_size.position, 500e-6, rtol=0.1, atol=0)
+    # inverse runs on every update and must not write to stdout
+    capsys.readouterr()
+    lensstack.inverse(x=lensstack.x.position, y=lensstack.y.position,
+                      z=lensstack.z.position)
+    assert capsys.readouterr().out == ''
+
+
+def test_lensstack_forward_cache(fake_lensstack):
+    logger.debug('test_lensstack_forward_cache')
+    lens = fake_lensstack
+    beam_size = 200e-6
+    assert not np.isclose(beam_size, lens.beam_size.position)
+    with patch.object(pcdsdevices.lens, '_dist_for_size_core',
+                      wraps=pcdsdevices.lens._dist_for_size_core) as core:
+        z_pos = lens.forward(calib_z=0, beam_size=beam_size).z
+        # Same request again reuses the last z position
+        assert lens.forward(calib_z=0, beam_size=beam_size).z == z_pos
+        assert core.call_count == 1
+        # A new energy recomputes
+        lens._E = 9
+        new_z_pos = lens.forward(calib_z=0, beam_size=beam_size).z
+        assert core.call_count == 2
+        assert not np.isclose(new_z_pos, z_pos)
+        # So does editing the lens set in place
+        lens.lens_set[0] = 4
+        lens.forward(calib_z=0, beam_size=beam_size)
+        assert core.call_count == 3
 
 
 def test_lensstack_align(presets, monkeypatch, fake_lensstack):
@@ -98,6 +130,53 @@ def test_lensstack_align(presets, monkeypatch, fake_lensstack):
     assert lens.z.position == 0
 
 
+def test_lensstack_align_presets_changed(presets, monkeypatch,
+                                         fake_lensstack):
+    logger.debug('test_lensstack_align_presets_changed')
+
+    def mocktweak(self):
+        lens.x.move(lens.x.position+1)
+        lens.y.move(lens.y.position+1)
+    lens = fake_lensstack
+    monkeypatch.setattr(LensStackBase, 'tweak', mocktweak)
+    lens.align(0)
+    z_one = lens.z.presets.positions.align_position_one.pos
+    z_two = lens.z.presets.positions.align_position_two.pos
+    x_one = lens.x.presets.positions.align_position_one.pos
+    lens.forward(calib_z=5, beam_size=lens.beam_size.position)
+    # Editing a preset outside of align must move the beam line
+    lens.x.presets.positions.align_position_two.update_pos(50)
+    real = lens.forward(calib_z=5, beam_size=lens.beam_size.position)
+    expected = (x_one - 50)/(z_one - z_two)*(5 - z_one) + x_one
+    assert np.isclose(real.x, expected)
+    # Deactivating a preset drops back to the current position
+    lens.x.presets.positions.align_position_two.deactivate()
+    real = lens.forward(calib_z=5, beam_size=lens.beam_size.position)
+    assert real.x == lens.x.position
+
+
+def test_lensstack_forward_many(presets, monkeypatch, fake_lensstack):
+    logger.debug('test_lensstack_forward_many')
+
+    def mocktweak(self):
+        lens.x.move(lens.x.position+1)
+        lens.y.move(lens.y.position+1)
+    lens = fake_lensstack
+    monkeypatch.setattr(LensStackBase, 'tweak', mocktweak)
+    lens.align(0)
+    sizes = [200e-6, 300e-6, 400e-6]
+    real = lens.forward_many(sizes)
+    assert real.z.shape == (3,)
+    for i, size in enumerate(sizes):
+        dist = lens.calc_distance_for_size(size, lens.lens_set, lens._E,
+                                           lens.beamsize_unfocused)[0]
+        z_pos = (dist - lens.z_offset) * lens.z_dir * 1000
+        assert np.isclose(real.z[i], z_pos)
+        single = lens._aligned_real_position(z_pos)
+        assert np.isclose(real.x[i], single.x)
+        assert np.isclose(real.y[i], single.y)
+
+
 def test_move(fake_lensstack):
     logger.debug('test_move')
     lensstack = fake_lensstack
@@ -109,18 +188,35 @@ def test_read_lens_file(fake_lensstack):
     logger.debug('test_read_lens_file')
     lensstack = fake_lensstack
     assert lensstack.lens_set == sample_lens_set
+    # Unchanged files are served from the cache as independent copies
+    cached = lensstack.read_lens()
+    cached.append(1)
+    assert lensstack.read_lens() == sample_lens_set
 
 
-def test_create_lens_file(fake_lensstack):
+def test_create_lens_file(fake_lensstack, tmp_path):
     logger.debug('test_create_lens_file')
     lensstack = fake_lensstack
-    lensstack.create_lens(lensstack.lens_set)
+    # Work on a copy of the legacy yaml file
+    lensstack.path = str(tmp_path / 'lens.yaml')
+    shutil.copyfile(sample_lens_file, lensstack.path)
+    new_lens_set = [1, 100e-6, 3, 300e-6]
+    lensstack.create_lens(new_lens_set)
     # Check that a backup was made
     assert os.path.exists(lensstack.backup_path)
     # Clean up the backup
     os.remove(lensstack.backup_path)
     # Check that the file we wrote is correct
-    assert lensstack.read_lens() == sample_lens_set
+    assert lensstack.read_lens() == new_lens_set
+    assert lensstack.lens_set == new_lens_set
+    # numpy values are written as plain numbers, keeping the file mode
+    os.chmod(lensstack.path, 0o640)
+    lensstack.create_lens([np.int64(1), np.float64(100e-6),
+                           np.int64(3), np.float64(300e-6)],
+                          make_backup=False)
+    assert lensstack.read_lens() == new_lens_set
+    assert os.stat(lensstack.path).st_mode & 0o777 == 0o640
+    assert not os.path.exists(lensstack.path + '.tmp')
 
 
 def test_calc_focal_length(fake_lensstack):
@@ -128,6 +224,19 @@ def test_calc_focal_length(fake_lensstack):
     lens = fake_lensstack
     number = lens.calc_focal_length(lens._E, (2, 200e-6, 4, 500e-6))
     assert np.isclose(number, 5.2150594897480556)
+    # Repeated calls give the same answer, a new lens set a new one
+    assert lens.calc_focal_length(lens._E, [2, 200e-6, 4, 500e-6]) == number
+    number = lens.calc_focal_length(lens._E, (2, 200e-6))
+    assert np.isclose(number, 9.387107081546501)
+
+
+def test_calc_focal_length_no_lenses(fake_lensstack):
+    logger.debug('test_calc_focal_length_no_lenses')
+    lens = fake_lensstack
+    with pytest.raises(ZeroDivisionError):
+        lens.calc_focal_length(lens._E, (None, None))
+    with pytest.raises(ZeroDivisionError):
+        lens.calc_focal_length(lens._E, ())
 
 
 def test_calc_focal_length_for_single_lens(fake_lensstack):
@@ -141,6 +250,10 @@ def test_get_delta(fake_lensstack):
     logger.debug('test_get_delta')
     lens = fake_lensstack
     assert np.isclose(lens.get_delta(E=sample_E), 5.326454632470501e-06)
+    # Repeated lookups with equivalent energies hit the cache
+    hits = _delta_cached.cache_info().hits
+    lens.get_delta(E=float(sample_E))
+    assert _delta_cached.cache_info().hits == hits + 1
 
 
 def test_calc_beam_fwhm(fake_lensstack):
@@ -149,16 +262,38 @@ def test_calc_beam_fwhm(fake_lensstack):
     h = lens.calc_beam_fwhm(8, sample_lens_set, distance=4,
                             fwhm_unfocused=500e-6)
     assert np.isclose(h, 0.00011649743222659306)
+    # Array distances give the same answer as the scalar path
+    h = lens.calc_beam_fwhm(8, sample_lens_set, distance=np.array([4, 4]),
+                            fwhm_unfocused=500e-6, printsummary=False)
+    assert np.allclose(h, 0.00011649743222659306)
 
 
 def test_make_safe(fake_lensstack):
     logger.debug('test_make_safe')
     lens = fake_lensstack
     assert lens._make_safe()
+    thickest = lens._att_obj.filters[-1]
+    assert lens._thickest_idx == len(lens._att_obj.filters) - 1
+    assert thickest.inserted
     lens._att_obj = None
     assert not lens._make_safe()
 
 
+def test_make_safe_insert_failed(caplog, monkeypatch, fake_lensstack):
+    logger.debug('test_make_safe_insert_failed')
+    lens = fake_lensstack
+    filt = lens._att_obj.filters[-1]
+
+    def failed_insert(*args, **kwargs):
+        status = StatusBase()
+        status.set_exception(UnknownStatusFailure('filter stuck'))
+        return status
+    monkeypatch.setattr(filt, 'insert', failed_insert)
+    with caplog.at_level(logging.WARNING):
+        assert not lens._make_safe()
+    assert 'filter stuck' in caplog.text
+
+
 def test_calc_distance_for_size(fake_lensstack):
     logger.debug('test_calc_distance_for_size')
     lens = fake_lensstack